@@ -2,123 +2,212 @@
 """
 South Park Political Theme Analysis
 Processes dialogue lines to identify political themes using keyword matching.
+
+Requires pyahocorasick: pip install pyahocorasick
 """
 
 import csv
+import heapq
 import json
-import re
-from collections import defaultdict
+import multiprocessing as mp
+from collections import Counter, defaultdict
+from functools import lru_cache
+from itertools import islice
 from pathlib import Path
 
+import ahocorasick
+
 def load_keywords(keywords_file):
     """Load keyword dictionary from JSON file."""
     with open(keywords_file, 'r', encoding='utf-8') as f:
         return json.load(f)
 
-def create_keyword_patterns(keywords_dict):
-    """Create compiled regex patterns for efficient matching."""
-    patterns = {}
+def create_keyword_automaton(keywords_dict):
+    """Build a single Aho-Corasick automaton over every theme keyword."""
+    automaton = ahocorasick.Automaton()
+    # Give each theme its own bit so a line's matches fit in one int
+    theme_bits = {theme: 1 << index for index, theme in enumerate(keywords_dict)}
+    keyword_themes = defaultdict(list)
     for theme, keywords in keywords_dict.items():
-        # Create word boundary patterns for each keyword
-        # This ensures we match whole words, not substrings
-        keyword_patterns = []
         for keyword in keywords:
-            # Escape special regex characters and add word boundaries
-            escaped = re.escape(keyword)
-            # Use word boundaries, but handle hyphenated words and numbers
-            pattern = r'\b' + escaped + r'\b'
-            keyword_patterns.append(pattern)
+            # The same keyword can belong to several themes
+            keyword_themes[keyword.lower()].append((theme, theme_bits[theme]))
+    
+    for keyword, themes in keyword_themes.items():
+        automaton.add_word(keyword, (tuple(themes), len(keyword)))
+    
+    automaton.make_automaton()
+    return automaton
+
+def _is_word_char(char):
+    """Match the characters covered by regex \\w."""
+    return char.isalnum() or char == '_'
+
+def accumulate_line_themes(text, automaton, counter):
+    """Add one to counter for each theme mentioned in a text string."""
+    text = text.lower()
+    last_index = len(text) - 1
+    seen = 0
+    # One pass over the line; check word boundaries on each hit so we
+    # match whole words, not substrings
+    for end_index, (themes, keyword_length) in automaton.iter(text):
+        start_index = end_index - keyword_length + 1
+        if start_index > 0 and _is_word_char(text[start_index - 1]):
+            continue
+        if end_index < last_index and _is_word_char(text[end_index + 1]):
+            continue
+        for theme, bit in themes:
+            if not seen & bit:
+                counter[theme] += 1
+                seen |= bit
+
+@lru_cache(maxsize=4)
+def _build_automaton(keywords_json):
+    """Compile and cache the automaton for a JSON-encoded keyword dictionary."""
+    return create_keyword_automaton(json.loads(keywords_json))
+
+# Automaton and shortest keyword length bound once per worker process by _init_worker
+_worker_automaton = None
+_worker_min_keyword_length = 0
+
+def _init_worker(automaton, min_keyword_length):
+    """Bind the keyword automaton for this worker process."""
+    # Only assign here: a Pool initializer that raises is restarted forever
+    global _worker_automaton, _worker_min_keyword_length
+    _worker_automaton = automaton
+    _worker_min_keyword_length = min_keyword_length
+
+def _scan_chunk(rows):
+    """Count theme occurrences per episode for a batch of dialogue rows."""
+    episode_themes = defaultdict(Counter)
+    episode_metadata = {}
+    
+    for text, (episode_key, episode_name) in rows:
+        # Store episode metadata (keys are packed season * 1000 + episode ints)
+        episode_metadata[episode_key] = episode_name
+        
+        # Lines shorter than the shortest keyword cannot match anything
+        if len(text) < _worker_min_keyword_length:
+            continue
         
-        # Combine all keywords for this theme into one pattern
-        combined_pattern = '|'.join(keyword_patterns)
-        patterns[theme] = re.compile(combined_pattern, re.IGNORECASE)
+        # Count the themes in this line straight into the episode's Counter
+        accumulate_line_themes(text, _worker_automaton, episode_themes[episode_key])
     
-    return patterns
+    # Only report episodes with at least one theme hit
+    episode_themes = {episode_key: counts for episode_key, counts in episode_themes.items() if counts}
+    return episode_themes, episode_metadata, len(rows)
 
-def find_themes_in_text(text, patterns):
-    """Find all themes mentioned in a text string."""
-    themes_found = set()
-    for theme, pattern in patterns.items():
-        if pattern.search(text):
-            themes_found.add(theme)
-    return themes_found
+def _iter_dialogue_rows(reader):
+    """Yield (text, (episode_key, episode_name)) for each dialogue row."""
+    # Locate columns once from the header and index rows positionally
+    header = next(reader, None)
+    if header is None:
+        return
+    text_index = header.index('text')
+    season_index = header.index('season_number')
+    episode_index = header.index('episode_number')
+    name_index = header.index('episode_name')
+    
+    # Episodes span hundreds of lines, so parse each episode's key once and
+    # share one (key, name) tuple between all of its lines
+    episode_cache = {}
+    for row in reader:
+        episode_id = (row[season_index], row[episode_index], row[name_index])
+        episode = episode_cache.get(episode_id)
+        if episode is None:
+            episode_key = int(row[season_index]) * 1000 + int(row[episode_index])
+            episode = episode_cache[episode_id] = (episode_key, row[name_index])
+        yield row[text_index], episode
+
+def _read_batches(reader, batch_size):
+    """Yield lists of dialogue rows from _iter_dialogue_rows."""
+    rows = _iter_dialogue_rows(reader)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
 
-def process_dialogue_data(input_csv, keywords_dict):
+def process_dialogue_data(input_csv, keywords_dict, processes=None, batch_size=10000):
     """Process dialogue data and count theme occurrences per episode."""
-    patterns = create_keyword_patterns(keywords_dict)
-    
-    # Dictionary to store counts: {(season, episode_number, episode_name): {theme: count}}
-    episode_themes = defaultdict(lambda: defaultdict(int))
+    # Dictionary to store counts: {season * 1000 + episode_number: {theme: count}}
+    episode_themes = defaultdict(Counter)
     episode_metadata = {}  # Store episode names
     
+    # Compile once up front and hand the result to the workers
+    automaton = _build_automaton(json.dumps(keywords_dict, sort_keys=True))
+    
+    # Lines shorter than the shortest keyword cannot match. With no keywords
+    # nothing can match (and an empty automaton cannot be scanned), so skip every line
+    min_keyword_length = min(
+        (len(keyword) for keywords in keywords_dict.values() for keyword in keywords),
+        default=float('inf'),
+    )
+    
     print(f"Loading dialogue data from {input_csv}...")
     
-    with open(input_csv, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
+    # Large buffer so the CSV parser is fed in 1 MiB reads
+    with open(input_csv, 'r', encoding='utf-8', newline='', buffering=1 << 20) as f:
+        reader = csv.reader(f)
         
+        # Lines are independent, so scan batches across all CPU cores
+        # and merge the partial counts as they come back
         line_count = 0
-        for row in reader:
-            line_count += 1
-            if line_count % 10000 == 0:
+        with mp.Pool(processes, initializer=_init_worker, initargs=(automaton, min_keyword_length)) as pool:
+            batches = pool.imap(_scan_chunk, _read_batches(reader, batch_size))
+            for partial_themes, partial_metadata, batch_lines in batches:
+                line_count += batch_lines
                 print(f"  Processed {line_count:,} lines...")
-            
-            text = row['text']
-            season = int(row['season_number'])
-            episode = int(row['episode_number'])
-            episode_name = row['episode_name']
-            
-            # Store episode metadata
-            episode_key = (season, episode)
-            episode_metadata[episode_key] = episode_name
-            
-            # Find themes in this line
-            themes = find_themes_in_text(text, patterns)
-            
-            # Increment count for each theme found
-            for theme in themes:
-                episode_themes[episode_key][theme] += 1
+                
+                for episode_key, counts in partial_themes.items():
+                    episode_themes[episode_key].update(counts)
+                episode_metadata.update(partial_metadata)
     
     print(f"Total lines processed: {line_count:,}")
     print(f"Total episodes found: {len(episode_themes)}")
     
     return episode_themes, episode_metadata
 
-def write_timeseries_csv(episode_themes, episode_metadata, output_csv):
-    """Write theme time series data to CSV in long format."""
-    print(f"\nWriting output to {output_csv}...")
-    
-    # Create list of all rows
-    rows = []
-    episode_order = 0
-    
+def _iter_timeseries_rows(episode_themes, episode_metadata):
+    """Yield (season, episode, name, order, theme, count) rows in output order."""
     # Sort episodes by season and episode number
     sorted_episodes = sorted(episode_themes.keys())
     
-    for season, episode in sorted_episodes:
-        episode_order += 1
-        episode_name = episode_metadata[(season, episode)]
-        themes = episode_themes[(season, episode)]
+    # Sort the theme names once rather than once per episode
+    all_themes = sorted({theme for themes in episode_themes.values() for theme in themes})
+    
+    for episode_order, episode_key in enumerate(sorted_episodes, start=1):
+        season, episode = divmod(episode_key, 1000)
+        episode_name = episode_metadata[episode_key]
+        themes = episode_themes[episode_key]
         
         # Only write rows where count > 0
-        for theme, count in sorted(themes.items()):
+        for theme in all_themes:
+            count = themes.get(theme, 0)
             if count > 0:
-                rows.append({
-                    'season': season,
-                    'episode_number': episode,
-                    'episode_name': episode_name,
-                    'episode_order': episode_order,
-                    'theme': theme,
-                    'count': count
-                })
-    
-    # Write to CSV
-    with open(output_csv, 'w', encoding='utf-8', newline='') as f:
+                yield season, episode, episode_name, episode_order, theme, count
+
+def write_timeseries_csv(episode_themes, episode_metadata, output_csv):
+    """Write theme time series data to CSV in long format."""
+    print(f"\nWriting output to {output_csv}...")
+    
+    # Keep a running count of the rows actually written
+    row_count = 0
+    
+    def counted_rows():
+        nonlocal row_count
+        for row in _iter_timeseries_rows(episode_themes, episode_metadata):
+            row_count += 1
+            yield row
+    
+    # Stream rows straight to the CSV with a single writerows call
+    with open(output_csv, 'w', encoding='utf-8', newline='', buffering=1 << 20) as f:
         fieldnames = ['season', 'episode_number', 'episode_name', 'episode_order', 'theme', 'count']
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(rows)
+        writer = csv.writer(f)
+        writer.writerow(fieldnames)
+        writer.writerows(counted_rows())
     
-    print(f"Written {len(rows):,} rows to {output_csv}")
+    print(f"Written {row_count:,} rows to {output_csv}")
 
 def generate_summary(episode_themes, episode_metadata, keywords_dict, output_file):
     """Generate summary statistics."""
@@ -133,20 +222,19 @@ def generate_summary(episode_themes, episode_metadata, keywords_dict, output_fil
     # Find episodes with highest activity per theme
     theme_top_episodes = defaultdict(list)
     for episode_key, themes in episode_themes.items():
-        season, episode = episode_key
+        season, episode = divmod(episode_key, 1000)
         episode_name = episode_metadata[episode_key]
         for theme, count in themes.items():
             theme_top_episodes[theme].append((count, season, episode, episode_name))
     
-    # Sort and keep top 5 per theme
+    # Keep top 5 per theme without sorting every episode
     for theme in theme_top_episodes:
-        theme_top_episodes[theme].sort(reverse=True)
-        theme_top_episodes[theme] = theme_top_episodes[theme][:5]
+        theme_top_episodes[theme] = heapq.nlargest(5, theme_top_episodes[theme])
     
     # Calculate seasonal trends
     season_totals = defaultdict(lambda: defaultdict(int))
     for episode_key, themes in episode_themes.items():
-        season, episode = episode_key
+        season, episode = divmod(episode_key, 1000)
         for theme, count in themes.items():
             season_totals[season][theme] += count
     